@@ -1,4 +1 @@
-from wa_tfm.client import MCPClient
-
-async def get_client() -> MCPClient:
-    return await MCPClient.get_instance()
\ No newline at end of file
+from ..client import get_client
@@ -1,19 +1,97 @@
+import asyncio
+import logging
+import os
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Optional
+
+import anthropic
 from fastapi import FastAPI
 from .routers import webhook_router, root_router
-from ..client import MCPClient
+from .routers.webhook.models import WhatsAppMessage
+from ..client import MCPClient, get_client
 from contextlib import asynccontextmanager
 import uvicorn
 
+BATCH_SIZE = 16
+BATCH_WINDOW = 0.02
+
+logger = logging.getLogger(__name__)
+
+def configure_logging() -> QueueListener:
+    """Route log records through a queue so emitting them never blocks the event loop"""
+    log_queue = SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    root.handlers = [QueueHandler(log_queue)]
+
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+async def process_message(client: MCPClient, message: WhatsAppMessage, embedding: Optional[list[float]]):
+    try:
+        response = await client.process_query(message=message, embedding=embedding)
+        logger.debug("Claude's response: %s", response)
+    except anthropic.APIStatusError as e:
+        # The SDK already retried retryable statuses; the traceback adds nothing here
+        logger.error("Claude API error %s for message %s: %s", e.status_code, message.message_id, e.message)
+    except anthropic.APIConnectionError as e:
+        logger.error("Could not reach Claude API for message %s: %s", message.message_id, e)
+    except Exception as e:
+        logger.exception("Worker error for message %s: %s", message.message_id, e)
+
+async def process_chat(client: MCPClient, items: list[tuple[WhatsAppMessage, Optional[list[float]]]]):
+    """Process one chat's messages one after another so its replies go out in order"""
+    for message, embedding in items:
+        await process_message(client, message, embedding)
+
+async def worker(queue: "asyncio.Queue[WhatsAppMessage]", client: MCPClient):
+    """Process queued webhook messages in small batches
+
+    Each tick waits briefly for more messages after the first one so the whole batch
+    can be embedded with a single API call. Different chats in the batch are then
+    processed concurrently, each chat's messages in arrival order.
+    """
+    while True:
+        batch = [await queue.get()]
+        await asyncio.sleep(BATCH_WINDOW)
+        while len(batch) < BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        try:
+            embeddings = await client.embed_messages(batch)
+            by_chat: dict[str, list[tuple[WhatsAppMessage, Optional[list[float]]]]] = {}
+            for message, embedding in zip(batch, embeddings):
+                by_chat.setdefault(message.chat_jid, []).append((message, embedding))
+            await asyncio.gather(*(process_chat(client, items) for items in by_chat.values()))
+        finally:
+            for _ in batch:
+                queue.task_done()
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    log_listener = configure_logging()
+
     # Initialize the client on startup
-    client = await MCPClient.get_instance()
+    client = await get_client()
     await client.connect_to_server("wa_tfm/whatsapp-mcp/whatsapp-mcp-server/main.py")
+
+    # Webhooks only enqueue messages; the workers do the slow Claude/MCP work. One worker per
+    # queue, and each chat maps to a single queue, so no two workers ever handle the same chat
+    workers = [asyncio.create_task(worker(queue, client)) for queue in client.queues]
     
     yield
     
     # Cleanup on shutdown
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
     await client.cleanup()
+    log_listener.stop()
 
 app = FastAPI(
     title="WhatsApp Message Handler",
@@ -26,4 +104,14 @@ app.include_router(webhook_router)
 app.include_router(root_router)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Queue, dedup set and MCP session are per process, so keep a single worker unless
+    # WEB_CONCURRENCY is set explicitly
+    uvicorn.run(
+        "babelbot.app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        # "auto" picks uvloop when it is installed; it isn't on Windows
+        loop="auto",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1"))
+    )
\ No newline at end of file
@@ -1,8 +1,11 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from datetime import datetime
 from typing import Optional
 
 class WhatsAppMessage(BaseModel):
+    # Immutable so a message can be shared safely between the buffer, queue and workers
+    model_config = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=True)
+
     timestamp: datetime
     sender: str
     content: str
@@ -1,3 +1,6 @@
+import logging
+import time
+from collections import OrderedDict
 from typing import Annotated
 
 from fastapi import APIRouter, Depends, HTTPException
@@ -6,6 +9,12 @@ from ....client import MCPClient
 from ...dependencies import get_client
 from .models import WebhookResponse, WhatsAppMessage
 
+logger = logging.getLogger(__name__)
+
+# Recently seen message IDs, so redelivered webhooks don't trigger a second Claude call
+MAX_SEEN_MESSAGE_IDS = 10_000
+SEEN_MESSAGE_IDS: OrderedDict[str, float] = OrderedDict()
+
 router = APIRouter(
     prefix="/webhook",
     tags=["webhook"],
@@ -17,28 +26,32 @@ async def webhook_handler(
     message: WhatsAppMessage,
     client: Annotated[MCPClient, Depends(get_client)]
 ):
+    if message.message_id in SEEN_MESSAGE_IDS:
+        logger.info("Ignoring duplicate delivery of message %s", message.message_id)
+        return WebhookResponse(
+            status="duplicate",
+            message="Message already received"
+        )
+    SEEN_MESSAGE_IDS[message.message_id] = time.monotonic()
+    if len(SEEN_MESSAGE_IDS) > MAX_SEEN_MESSAGE_IDS:
+        SEEN_MESSAGE_IDS.popitem(last=False)
+
     try:
-        print(f"Received message:")
-        print(f"From: {message.sender}")
-        print(f"Content: {message.content}")
-        print(f"Time: {message.timestamp}")
-        print(f"Chat JID: {message.chat_jid}")
-        if message.media_type:
-            print(f"Media Type: {message.media_type}")
-
-        response = await client.process_query(
-            message=message
+        logger.info("Received message %s from %s in %s", message.message_id, message.sender, message.chat_jid)
+        logger.debug(
+            "Content: %s | Time: %s | Media Type: %s",
+            message.content, message.timestamp, message.media_type
         )
-        print(f"Claude's response: {response}")
+
+        # Return immediately so the sender doesn't time out and retry; workers process the queue
+        await client.enqueue(message)
         
         return WebhookResponse(
-            status="success",
-            message="Message processed successfully"
+            status="queued",
+            message="Message queued for processing"
         )
     except Exception as e:
-        import traceback
-        print(f"Webhook error: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Webhook error: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Error processing message: {str(e)}"
@@ -1 +1 @@
-from .client import MCPClient
\ No newline at end of file
+from .client import MCPClient, get_client
\ No newline at end of file
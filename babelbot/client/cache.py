@@ -0,0 +1,62 @@
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+
+
+class SemanticCache:
+    """Bounded LRU cache of Claude responses keyed by (chat_jid, content embedding).
+
+    Entries are scoped to a single chat so a hit can never leak one user's reply
+    into another chat, and expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int = 512, ttl: float = 3600.0, threshold: float = 0.92):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        # key -> (expires_at, chat_jid, normalized embedding, cached value)
+        self._entries: OrderedDict[int, tuple[float, str, np.ndarray, Any]] = OrderedDict()
+        self._next_key = 0
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _evict_expired(self, now: float):
+        expired = [key for key, entry in self._entries.items() if entry[0] <= now]
+        for key in expired:
+            del self._entries[key]
+
+    def lookup(self, chat_jid: str, embedding) -> Optional[Any]:
+        """Return the cached value most similar to `embedding` above the threshold, if any."""
+        self._evict_expired(time.monotonic())
+        keys = [key for key, entry in self._entries.items() if entry[1] == chat_jid]
+        if not keys:
+            return None
+
+        query = self._normalize(embedding)
+        matrix = np.stack([self._entries[key][2] for key in keys])
+        similarities = matrix @ query
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+
+        key = keys[best]
+        self._entries.move_to_end(key)
+        return self._entries[key][3]
+
+    def store(self, chat_jid: str, embedding, value: Any):
+        """Cache `value` for `chat_jid` under `embedding`, evicting the least recently used entry."""
+        self._entries[self._next_key] = (
+            time.monotonic() + self.ttl,
+            chat_jid,
+            self._normalize(embedding),
+            value
+        )
+        self._next_key += 1
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
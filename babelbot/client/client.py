@@ -1,38 +1,59 @@
 import asyncio
-import json
+import inspect
+import logging
+import mimetypes
+import uuid
 from contextlib import AsyncExitStack
-from typing import ClassVar, Optional
-
-from anthropic import Anthropic
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import anyio
+import httpx
+import orjson
+from aiolimiter import AsyncLimiter
+from anthropic import AsyncAnthropic
+from anthropic.types import Message
 from dotenv import load_dotenv
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from mcp.shared.exceptions import McpError
+from mcp.types import CallToolResult
 from openai import AsyncOpenAI
 
 from ..app.routers.webhook.models import WhatsAppMessage
+from .cache import SemanticCache
+from .models import DownloadResult
 
 load_dotenv()
 
-class MCPClient:
-    _instance: ClassVar[Optional['MCPClient']] = None
-    _initialized: bool = False
-    _initialization_lock = asyncio.Lock()
+logger = logging.getLogger(__name__)
 
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-        return cls._instance
+# Only replies that consist purely of outbound messages are safe to replay from the cache
+_REPLAYABLE_TOOLS = frozenset({"send_message", "send_voice_message"})
 
-    def __init__(self):
-        if not self._initialized:
-            self.session: Optional[ClientSession] = None
-            self.exit_stack = AsyncExitStack()
-            self.anthropic = Anthropic()
-            self.openai = AsyncOpenAI()
-            self.openai
-            self._initialized = True
-
-            self.system_prompt = """You are a WhatsApp Helper Agent designed to assist users in translating and rewriting their messages for WhatsApp conversations in a culturally appropriate, fluent, and context-sensitive way. Users will send you text or voice messages in their native language, expressing what they want to communicate and to whom. Your task is to deeply understand their intent, infer the proper tone based on the relationship and context (e.g., casual friend, work colleague, boss), and craft a native-sounding WhatsApp message in the target language.
+# Seconds of silence in a chat before its buffered text messages are processed together
+_BUFFER_WINDOW = 3.0
+
+# Number of message queues; a chat always maps to the same one, so one worker sees all of it
+_NUM_QUEUES = 4
+
+# Upper bound on Claude -> tool -> Claude round trips for a single message
+_MAX_TOOL_ROUNDS = 5
+
+# Raised by the stdio transport once the MCP server process has gone away
+_TRANSPORT_ERRORS = (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream, BrokenPipeError)
+
+# Error code the SDK fails pending requests with when the connection closes
+# (mcp.types.CONNECTION_CLOSED in SDK versions that define it)
+_MCP_CONNECTION_CLOSED = -32000
+
+# Seconds a tool call waits for the MCP server to come back, and the reconnect backoff bounds
+_RECONNECT_TIMEOUT = 30.0
+_RECONNECT_BACKOFF = (0.5, 30.0)
+
+# cleandoc strips the source indentation so it isn't sent (and billed) as tokens on every call
+_SYSTEM_PROMPT = inspect.cleandoc("""You are a WhatsApp Helper Agent designed to assist users in translating and rewriting their messages for WhatsApp conversations in a culturally appropriate, fluent, and context-sensitive way. Users will send you text or voice messages in their native language, expressing what they want to communicate and to whom. Your task is to deeply understand their intent, infer the proper tone based on the relationship and context (e.g., casual friend, work colleague, boss), and craft a native-sounding WhatsApp message in the target language.
             If the user requests your help to formulate a message for them to send to another person, comply and draft a WhatsApp message 
             according to the user's request. Make sure the message is authentic and follows the user's instructions. Return only the 
             formulated message and nothing else. If the user's request is not related to formulating a message, respond with 'I am only here 
@@ -86,15 +107,60 @@ class MCPClient:
 
             IN ANY CASE USE THE 'send_message' OR 'send_voice_message' TOOL TO COMMUNICATE YOUR ANSWER TO THE USER, OTHERWISE HE WILL NOT SEE YOUR RESPONSE.
             Do not include any meta-commentary about using tools or sending messages - just provide the response content.
-            """
+            """)
+
+# The system prompt never changes, so mark it as a prompt-cache breakpoint
+_SYSTEM_BLOCKS = ({
+    "type": "text",
+    "text": _SYSTEM_PROMPT,
+    "cache_control": {"type": "ephemeral"}
+},)
+
+def _is_connection_lost(error: Exception) -> bool:
+    """Whether a tool call failed because the MCP server connection is gone"""
+    if isinstance(error, McpError):
+        return error.error.code == _MCP_CONNECTION_CLOSED
+    return isinstance(error, _TRANSPORT_ERRORS)
+
+def _tool_succeeded(result: CallToolResult) -> bool:
+    """Whether an MCP tool result reports success, i.e. isn't an error and says {"success": true}"""
+    if result.isError or not result.content or result.content[0].type != "text":
+        return False
+    try:
+        payload = orjson.loads(result.content[0].text)
+    except orjson.JSONDecodeError:
+        return False
+    return isinstance(payload, dict) and payload.get("success") is True
 
-    @classmethod
-    async def get_instance(cls) -> 'MCPClient':
-        if cls._instance is None:
-            async with cls._initialization_lock:
-                if cls._instance is None:
-                    cls._instance = cls()
-        return cls._instance
+class MCPClient:
+    def __init__(self):
+        self.session: Optional[ClientSession] = None
+        # The supervisor task owns the MCP connection; anyio contexts must be exited by the task
+        # that entered them, so reconnects are requested from it rather than done by callers
+        self._supervisor: Optional[asyncio.Task] = None
+        self._session_ready = asyncio.Event()
+        self._reconnect_requested = asyncio.Event()
+        self._tools_plain: tuple[dict, ...] = ()
+        self._tools_cached: tuple[dict, ...] = ()
+        # One pooled HTTP/2 client for both SDKs, so requests multiplex over warm connections
+        self._http = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+        )
+        self.anthropic = AsyncAnthropic(http_client=self._http)
+        self.openai = AsyncOpenAI(http_client=self._http)
+        # Client-side token buckets so bursts of webhooks don't run into 429s upstream
+        self._claude_limiter = AsyncLimiter(max_rate=50, time_period=1)
+        self._openai_limiter = AsyncLimiter(max_rate=50, time_period=1)
+        # The limiters pace request starts; these cap how many are in flight at once
+        self._claude_sem = asyncio.Semaphore(16)
+        self._openai_sem = asyncio.Semaphore(8)
+        self._sem_cache = SemanticCache(maxsize=512, ttl=3600, threshold=0.92)
+        self.queues: tuple[asyncio.Queue[WhatsAppMessage], ...] = tuple(
+            asyncio.Queue() for _ in range(_NUM_QUEUES)
+        )
+        self._pending: dict[str, list[WhatsAppMessage]] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
 
     async def connect_to_server(self, server_script_path: str):
         """Connect to an MCP server
@@ -114,65 +180,278 @@ class MCPClient:
             env=None
         )
 
-        stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        self.stdio, self.write = stdio_transport
-        self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
+        connected = asyncio.get_running_loop().create_future()
+        self._supervisor = asyncio.create_task(self._supervise_session(server_params, connected))
+        await connected
 
-        await self.session.initialize()
+    async def _supervise_session(self, server_params: StdioServerParameters, connected: asyncio.Future):
+        """Hold the MCP connection open, reopening it whenever a caller reports it broken
 
-        # List available tools
+        Args:
+            server_params: How to start the server process
+            connected: Resolved once the first connection is up, or failed if it can't be made
+        """
+        backoff = _RECONNECT_BACKOFF[0]
+        try:
+            while True:
+                try:
+                    async with AsyncExitStack() as stack:
+                        read, write = await stack.enter_async_context(stdio_client(server_params))
+                        session = await stack.enter_async_context(ClientSession(read, write))
+                        await session.initialize()
+                        # Registered last so it runs first: callers stop using the session as
+                        # soon as the connection starts closing, for whatever reason it closes
+                        stack.callback(self._mark_disconnected)
+                        self.session = session
+                        await self.refresh_tools()
+
+                        backoff = _RECONNECT_BACKOFF[0]
+                        self._reconnect_requested.clear()
+                        self._session_ready.set()
+                        if not connected.done():
+                            connected.set_result(None)
+
+                        await self._reconnect_requested.wait()
+                        logger.warning("MCP server connection lost, reconnecting")
+                except Exception as e:
+                    if not connected.done():
+                        connected.set_exception(e)
+                        return
+                    logger.exception("MCP server connection failed, retrying in %ss: %s", backoff, e)
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, _RECONNECT_BACKOFF[1])
+        finally:
+            self._session_ready.clear()
+            if not connected.done():
+                connected.cancel()
+
+    def _mark_disconnected(self):
+        self._session_ready.clear()
+        self.session = None
+
+    async def _call_tool(self, name: str, arguments: dict):
+        """Call an MCP tool, reconnecting if the server connection has died
+
+        Other tools are retried once on the new connection. Send tools are not: the request may
+        have reached the bridge before the pipe broke, and a retry would send the message twice.
+        """
+        await asyncio.wait_for(self._session_ready.wait(), _RECONNECT_TIMEOUT)
+        session = self.session
+        try:
+            return await session.call_tool(name, arguments)
+        except Exception as e:
+            if not _is_connection_lost(e):
+                raise
+            # Only the first caller to see this session fail asks the supervisor to reconnect
+            if self.session is session:
+                self._mark_disconnected()
+                self._reconnect_requested.set()
+            if name.startswith("send_"):
+                raise
+            await asyncio.wait_for(self._session_ready.wait(), _RECONNECT_TIMEOUT)
+            return await self.session.call_tool(name, arguments)
+
+    async def refresh_tools(self):
+        """Fetch the server's tools and rebuild the Claude tool schemas, e.g. after a server reload."""
         response = await self.session.list_tools()
         tools = response.tools
-        print("\nConnected to server with tools:", [tool.name for tool in tools])
+        logger.info("MCP server tools: %s", [tool.name for tool in tools])
+
+        # The tool set is static for the session, so build the Claude tool schemas once
+        self._tools_plain = tuple({
+            "name": tool.name,
+            "description": tool.description,
+            "input_schema": tool.inputSchema
+        } for tool in tools)
+        # Cache breakpoint on the last tool caches the tool definitions, which come first in the
+        # prompt; the breakpoint on _SYSTEM_BLOCKS then covers tools + system together
+        self._tools_cached = self._tools_plain[:-1] + tuple(
+            {**tool, "cache_control": {"type": "ephemeral"}} for tool in self._tools_plain[-1:]
+        )
 
     async def transcribe_audio(self, audio_path: str) -> str:
         """Transcribe audio file using OpenAI's Whisper API"""
         try:
-            with open(audio_path, "rb") as audio_file:
+            # Read the file off the event loop so other webhooks keep being served meanwhile
+            audio_data = await asyncio.to_thread(Path(audio_path).read_bytes)
+            content_type = mimetypes.guess_type(audio_path)[0] or "audio/ogg"
+            async with self._openai_sem, self._openai_limiter:
                 transcript = await self.openai.audio.transcriptions.create(
                     model="gpt-4o-transcribe",
-                    file=audio_file,
+                    file=(Path(audio_path).name, audio_data, content_type),
                     response_format="text"
                 )
-                return transcript
+            return transcript
         except Exception as e:
-            print(f"Transcription error: {str(e)}")
+            logger.exception("Transcription error: %s", e)
+            raise
+
+    async def enqueue(self, message: WhatsAppMessage):
+        """Queue a message for processing, coalescing rapid bursts of text messages per chat"""
+        if message.media_type:
+            # Flush buffered text first so it is queued ahead of the media message. The chat always
+            # maps to the same queue and its worker processes a chat sequentially, so order holds
+            self._flush(message.chat_jid)
+            await self._queue_for(message.chat_jid).put(message)
+            return
+
+        self._pending.setdefault(message.chat_jid, []).append(message)
+        timer = self._timers.pop(message.chat_jid, None)
+        if timer:
+            timer.cancel()
+        self._timers[message.chat_jid] = asyncio.get_running_loop().call_later(
+            _BUFFER_WINDOW, self._flush, message.chat_jid
+        )
+
+    def _queue_for(self, chat_jid: str) -> asyncio.Queue:
+        return self.queues[hash(chat_jid) % len(self.queues)]
+
+    def _flush(self, chat_jid: str):
+        """Merge a chat's buffered messages into one and hand it to the queue"""
+        timer = self._timers.pop(chat_jid, None)
+        if timer:
+            timer.cancel()
+        pending = self._pending.pop(chat_jid, None)
+        if not pending:
+            return
+
+        # Keep the latest timestamp/message_id and join the fragments in arrival order
+        merged = pending[-1].model_copy(update={
+            "content": "\n".join(m.content for m in pending)
+        })
+        self._queue_for(chat_jid).put_nowait(merged)
+
+    async def embed_messages(self, messages: list[WhatsAppMessage]) -> list[Optional[list[float]]]:
+        """Embed a batch of messages for semantic cache lookups with a single API call
+
+        Media messages are not cached and get None, as do all messages if the request fails.
+        """
+        texts = [m.content for m in messages if not m.media_type and m.content]
+        if not texts:
+            return [None] * len(messages)
+
+        try:
+            async with self._openai_sem, self._openai_limiter:
+                response = await self.openai.embeddings.create(
+                    model="text-embedding-3-small",
+                    input=texts
+                )
+        except Exception as e:
+            logger.exception("Embedding error: %s", e)
+            return [None] * len(messages)
+
+        embeddings = iter(d.embedding for d in sorted(response.data, key=lambda d: d.index))
+        return [next(embeddings) if not m.media_type and m.content else None for m in messages]
+
+    async def _stream_message(
+        self,
+        messages: list[dict],
+        tools: tuple[dict, ...]
+    ) -> tuple[Message, dict[str, asyncio.Task]]:
+        """Stream a Claude response, paced by the client-side rate limiter
+
+        Each tool call is started as soon as its tool_use block has finished streaming, so
+        MCP tool execution overlaps with the rest of the response arriving.
+
+        Returns:
+            The final message and the started tool call tasks keyed by tool_use id
+        """
+        tool_tasks: dict[str, asyncio.Task] = {}
+        try:
+            async with self._claude_sem, self._claude_limiter:
+                async with self.anthropic.messages.stream(
+                    model="claude-sonnet-4-20250514",
+                    system=_SYSTEM_BLOCKS,
+                    max_tokens=1000,
+                    messages=messages,
+                    tools=tools
+                ) as stream:
+                    async for event in stream:
+                        if event.type == "content_block_stop" and event.content_block.type == "tool_use":
+                            block = event.content_block
+                            tool_tasks[block.id] = asyncio.create_task(
+                                self._call_tool(block.name, block.input)
+                            )
+                    response = await stream.get_final_message()
+        except BaseException:
+            for task in tool_tasks.values():
+                task.cancel()
             raise
+        return response, tool_tasks
+
+    async def _replay_cached(self, tool_calls: list[tuple[str, dict]], final_text: str) -> str:
+        """Re-send a cached reply by replaying its tool calls"""
+        for tool_name, tool_args in tool_calls:
+            await self._call_tool(tool_name, tool_args)
+        return final_text
+
+    async def _transcribe_message(self, message: WhatsAppMessage) -> str:
+        """Download an audio message through the MCP server and transcribe it
+
+        Returns:
+            The transcript, or a placeholder the model can reply to if either step fails
+        """
+        try:
+            download_result = await self._call_tool("download_media", {
+                "message_id": message.message_id,
+                "chat_jid": message.chat_jid
+            })
 
-    async def process_query(self, message: WhatsAppMessage) -> str:
-        """Process a query using Claude and available tools"""
+            if not download_result or not download_result.content:
+                logger.warning("No valid download result")
+                return "[Failed to download audio message]"
+
+            # Validate straight from the JSON text; pydantic-core parses it without a dict in between
+            result = DownloadResult.model_validate_json(download_result.content[0].text)
+            logger.debug("Parsed result: %s", result)
+
+            if not result.success or not result.file_path:
+                logger.warning("Download failed: %s", result.message)
+                return "[Failed to download audio message]"
+
+            audio_path = result.file_path
+            logger.debug("Audio downloaded to: %s", audio_path)
+
+            transcript = await self.transcribe_audio(audio_path)
+            logger.debug("Transcription: %s", transcript)
+            return transcript
+        except Exception as e:
+            logger.exception("Error processing audio: %s", e)
+            return "[Failed to download audio message]"
+
+    async def process_query(
+        self,
+        message: WhatsAppMessage,
+        embedding: Optional[list[float]] = None
+    ) -> str:
+        """Process a query using Claude and available tools
+
+        Args:
+            message: The incoming WhatsApp message
+            embedding: Precomputed embedding of the message content, e.g. from a batched
+                embed_messages call; computed on demand when omitted
+        """
         if message.media_type:
             if message.media_type == "audio":
-                try:
-                    download_result = await self.session.call_tool("download_media", {
-                        "message_id": message.message_id,
-                        "chat_jid": message.chat_jid
-                    })
-                    
-                    if download_result and download_result.content:
-                        # Parse the JSON string from the text content
-                        result_json = json.loads(download_result.content[0].text)
-                        print("Parsed result:", result_json)
-                        
-                        if result_json.get("success"):
-                            audio_path = result_json.get("file_path")
-                            print(f"Audio downloaded to: {audio_path}")
-                            
-                            # Transcribe the audio
-                            transcript = await self.transcribe_audio(audio_path)
-                            print(f"Transcription: {transcript}")
-                        else:
-                            print("Download failed:", result_json.get("message"))
-                            transcript = "[Failed to download audio message]"
-                    else:
-                        print("No valid download result")
-                        transcript = "[Failed to download audio message]"
-                except Exception as e:
-                    print(f"Error processing audio: {str(e)}")
-                    transcript = "[Failed to download audio message]" 
-                message.content = transcript
+                message = message.model_copy(update={
+                    "content": await self._transcribe_message(message)
+                })
             else:
-                message.content = f"User provided not supported media type {message.media_type}!"
+                message = message.model_copy(update={
+                    "content": f"User provided not supported media type {message.media_type}!"
+                })
+
+        # Media content is dynamic, so only plain text messages go through the semantic cache
+        if message.media_type:
+            embedding = None
+        elif embedding is None:
+            embedding = (await self.embed_messages([message]))[0]
+
+        if embedding is not None:
+            cached = self._sem_cache.lookup(message.chat_jid, embedding)
+            if cached is not None:
+                logger.debug("Semantic cache hit for %s", message.chat_jid)
+                return await self._replay_cached(*cached)
 
         query = {
             "sender": message.sender,
@@ -183,69 +462,70 @@ class MCPClient:
         messages = [
             {
                 "role": "user",
-                "content": json.dumps(query)
+                "content": orjson.dumps(query).decode()
             }
         ]
 
-        response = await self.session.list_tools()
-        available_tools = [{
-            "name": tool.name,
-            "description": tool.description,
-            "input_schema": tool.inputSchema
-        } for tool in response.tools]
+        available_tools = self._tools_cached
 
         # Initial Claude API call
-        response = self.anthropic.messages.create(
-            model="claude-sonnet-4-20250514",
-            system=self.system_prompt,
-            max_tokens=1000,
-            messages=messages,
-            tools=available_tools
-        )
-
-        # Process response and handle tool calls
-        final_text = []
-
-        assistant_message_content = []
-        for content in response.content:
-            if content.type == 'text':
-                final_text.append(content.text)
-                assistant_message_content.append(content)
-            elif content.type == 'tool_use':
-                tool_name = content.name
-                tool_args = content.input
-
-                # Execute tool call
-                result = await self.session.call_tool(tool_name, tool_args)
-                final_text.append(f"[Calling tool {tool_name} with args {tool_args}]")
-
-                assistant_message_content.append(content)
-                messages.append({
-                    "role": "assistant",
-                    "content": assistant_message_content
-                })
-                messages.append({
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "tool_result",
-                            "tool_use_id": content.id,
-                            "content": result.content
-                        }
-                    ]
-                })
-
-                # Get next response from Claude
-                response = self.anthropic.messages.create(
-                    model="claude-sonnet-4-20250514",
-                    max_tokens=1000,
-                    messages=messages,
-                    tools=available_tools
-                )
-
-                final_text.append(response.content[0].text)
-
-        return "\n".join(final_text)
+        response, tool_tasks = await self._stream_message(messages, available_tools)
+        logger.debug("Prompt cache read tokens: %s", response.usage.cache_read_input_tokens)
+
+        # Process responses, running tool calls until Claude stops asking for them
+        tool_calls = []
+        # A reply is only worth replaying if every send in it actually went through
+        all_succeeded = True
+
+        for round_number in range(_MAX_TOOL_ROUNDS + 1):
+            # Only the last response's text is the reply; earlier rounds are tool-use preamble
+            final_text = [content.text for content in response.content if content.type == 'text']
+            tool_uses = [content for content in response.content if content.type == 'tool_use']
+            if not tool_uses:
+                break
+
+            # The tool calls were already started while the response was streaming in
+            results = await asyncio.gather(*(tool_tasks[tool_use.id] for tool_use in tool_uses))
+            for tool_use, result in zip(tool_uses, results):
+                tool_calls.append((tool_use.name, tool_use.input))
+                all_succeeded = all_succeeded and _tool_succeeded(result)
+                logger.debug("Called tool %s with args %s", tool_use.name, tool_use.input)
+
+            if response.stop_reason != "tool_use":
+                break
+            if round_number == _MAX_TOOL_ROUNDS:
+                logger.warning("Giving up after %s tool rounds for %s", _MAX_TOOL_ROUNDS, message.chat_jid)
+                break
+
+            messages.append({
+                "role": "assistant",
+                "content": response.content
+            })
+            messages.append({
+                "role": "user",
+                "content": [
+                    {
+                        "type": "tool_result",
+                        "tool_use_id": tool_use.id,
+                        "content": result.content
+                    }
+                    for tool_use, result in zip(tool_uses, results)
+                ]
+            })
+
+            # Get next response from Claude
+            response, tool_tasks = await self._stream_message(messages, available_tools)
+
+        reply = "\n".join(final_text)
+        if (
+            embedding is not None
+            and tool_calls
+            and all_succeeded
+            and all(name in _REPLAYABLE_TOOLS for name, _ in tool_calls)
+        ):
+            self._sem_cache.store(message.chat_jid, embedding, (tool_calls, reply))
+
+        return reply
     
     async def chat_loop(self):
         """Run an interactive chat loop"""
@@ -254,17 +534,43 @@ class MCPClient:
 
         while True:
             try:
-                query = input("\nQuery: ").strip()
+                # input() blocks, so read it in a thread to keep the event loop serving
+                query = (await asyncio.to_thread(input, "\nQuery: ")).strip()
 
                 if query.lower() == 'quit':
                     break
 
-                response = await self.process_query(query)
+                response = await self.process_query(WhatsAppMessage(
+                    timestamp=datetime.now(),
+                    sender="cli",
+                    content=query,
+                    chat_jid="cli",
+                    is_from_me=False,
+                    message_id=uuid.uuid4().hex
+                ))
                 print("\n" + response)
 
             except Exception as e:
-                print(f"\nError: {str(e)}")
+                logger.exception("Chat loop error: %s", e)
 
     async def cleanup(self):
         """Clean up resources"""
-        await self.exit_stack.aclose()
\ No newline at end of file
+        for timer in self._timers.values():
+            timer.cancel()
+        if self._supervisor:
+            # Cancelling the supervisor closes the connection from the task that opened it
+            self._supervisor.cancel()
+            await asyncio.gather(self._supervisor, return_exceptions=True)
+        await self._http.aclose()
+
+_client: Optional[MCPClient] = None
+_client_lock = asyncio.Lock()
+
+async def get_client() -> MCPClient:
+    """Return the process-wide MCPClient, creating it on first use"""
+    global _client
+    if _client is None:
+        async with _client_lock:
+            if _client is None:
+                _client = MCPClient()
+    return _client
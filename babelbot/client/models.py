@@ -0,0 +1,10 @@
+from pydantic import BaseModel, ConfigDict
+from typing import Optional
+
+class DownloadResult(BaseModel):
+    """JSON payload returned by the MCP server's download_media tool"""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+    success: bool
+    message: Optional[str] = None
+    file_path: Optional[str] = None
@@ -86,6 +86,15 @@ func NewMessageStore() (*MessageStore, error) {
 			PRIMARY KEY (id, chat_jid),
 			FOREIGN KEY (chat_jid) REFERENCES chats(jid)
 		);
+
+		-- Serves per-chat history, keyset pagination and last-message lookups as index seeks
+		CREATE INDEX IF NOT EXISTS idx_messages_chat_timestamp ON messages (chat_jid, timestamp DESC, id);
+
+		-- Serves sender filters (list_messages, contact chats, last interaction) in timestamp order
+		CREATE INDEX IF NOT EXISTS idx_messages_sender_timestamp ON messages (sender, timestamp DESC);
+
+		-- Lets sender name lookups match a bare phone number to its chat JID by equality
+		CREATE INDEX IF NOT EXISTS idx_chats_phone ON chats (substr(jid, 1, instr(jid, '@') - 1));
 	`)
 	if err != nil {
 		db.Close()
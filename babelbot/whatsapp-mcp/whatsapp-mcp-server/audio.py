@@ -1,6 +1,55 @@
+import functools
 import os
 import subprocess
 import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# (absolute path, mtime_ns, size, bitrate, sample_rate) -> converted temporary .ogg file
+_CONVERTED_MAXSIZE = 256
+_converted = OrderedDict()
+_converted_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=256)
+def _probe_audio_codec(input_file, mtime_ns, size) -> Optional[str]:
+    # mtime and size are part of the cache key so an overwritten file is probed again
+    try:
+        process = subprocess.run(
+            [
+                "ffprobe",
+                "-v", "error",
+                "-select_streams", "a:0",
+                "-show_entries", "stream=codec_name",
+                "-of", "csv=p=0",
+                input_file
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return process.stdout.strip() or None
+
+
+def is_opus_ogg(input_file):
+    """
+    Check whether an audio file can be sent as a voice message without conversion.
+    
+    Args:
+        input_file (str): Path to the audio file
+    
+    Returns:
+        bool: True if the file has an .ogg extension and its audio stream is Opus. If
+              ffprobe is unavailable or can't read the file, the extension alone decides.
+    """
+    if not input_file.lower().endswith(".ogg"):
+        return False
+    stat = os.stat(input_file)
+    return _probe_audio_codec(input_file, stat.st_mtime_ns, stat.st_size) in (None, "opus")
+
 
 def convert_to_opus_ogg(input_file, output_file=None, bitrate="32k", sample_rate=24000):
     """
@@ -35,6 +84,7 @@ def convert_to_opus_ogg(input_file, output_file=None, bitrate="32k", sample_rate
     # Build the ffmpeg command
     cmd = [
         "ffmpeg",
+        "-loglevel", "error",        # Only keep errors on stderr instead of per-frame progress
         "-i", input_file,
         "-c:a", "libopus",
         "-b:a", bitrate,
@@ -48,10 +98,10 @@ def convert_to_opus_ogg(input_file, output_file=None, bitrate="32k", sample_rate
     ]
     
     try:
-        # Run the ffmpeg command and capture output
-        process = subprocess.run(
+        # Run the ffmpeg command; only stderr is captured, for the error message
+        subprocess.run(
             cmd,
-            stdout=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
             text=True,
             check=True
@@ -92,6 +142,45 @@ def convert_to_opus_ogg_temp(input_file, bitrate="32k", sample_rate=24000):
         raise e
 
 
+def convert_to_opus_ogg_cached(input_file, bitrate="32k", sample_rate=24000):
+    """
+    Like convert_to_opus_ogg_temp, but reuse the earlier conversion of an unchanged file.
+    
+    Args:
+        input_file (str): Path to the input audio file
+        bitrate (str, optional): Target bitrate for Opus encoding (default: "32k")
+        sample_rate (int, optional): Sample rate for output (default: 24000)
+    
+    Returns:
+        str: Path to the temporary file with the converted audio
+        
+    Raises:
+        FileNotFoundError: If the input file doesn't exist
+        RuntimeError: If the ffmpeg conversion fails
+    """
+    if not os.path.isfile(input_file):
+        raise FileNotFoundError(f"Input file not found: {input_file}")
+
+    # mtime and size change whenever the source is rewritten, so a stale conversion is never reused
+    stat = os.stat(input_file)
+    key = (os.path.abspath(input_file), stat.st_mtime_ns, stat.st_size, bitrate, sample_rate)
+    with _converted_lock:
+        output_file = _converted.get(key)
+        if output_file is not None:
+            if os.path.exists(output_file):
+                _converted.move_to_end(key)
+                return output_file
+            # The temporary file was cleaned up behind our back
+            del _converted[key]
+
+    output_file = convert_to_opus_ogg_temp(input_file, bitrate, sample_rate)
+    with _converted_lock:
+        _converted[key] = output_file
+        while len(_converted) > _CONVERTED_MAXSIZE:
+            _converted.popitem(last=False)
+    return output_file
+
+
 if __name__ == "__main__":
     # Example usage
     import sys
@@ -0,0 +1,82 @@
+import asyncio
+import functools
+import inspect
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+def ttl_cache(ttl: float, maxsize: int = 1024):
+    """Cache the results of an async function for `ttl` seconds, keyed on its arguments.
+
+    Concurrent calls with identical arguments share a single in-flight call. The wrapped
+    function gets a `cache_clear()` method for invalidation after writes, and a
+    `cache_invalidate(*args, **kwargs)` method to drop the result of a single call.
+
+    Args:
+        ttl: Number of seconds a result stays valid
+        maxsize: Maximum number of cached results; the least recently used is evicted first
+    """
+    def decorator(fn: Callable[..., Awaitable[Any]]):
+        entries: OrderedDict[Tuple, Tuple[float, Any]] = OrderedDict()
+        in_flight: Dict[Tuple, asyncio.Task] = {}
+        # Bumped on every clear so calls started before an invalidation don't store stale results
+        generation = 0
+        # In-flight calls dropped by cache_invalidate; only their own key stops caching
+        invalidated: weakref.WeakSet = weakref.WeakSet()
+        signature = inspect.signature(fn)
+
+        def _key(args, kwargs) -> Tuple:
+            # Bind to the signature so positional, keyword and defaulted calls share one entry
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return tuple(bound.arguments.items())
+
+        def _forget(key: Tuple, task: asyncio.Task):
+            # Only drop the entry if a cache_clear hasn't already replaced it with a newer call
+            if in_flight.get(key) is task:
+                del in_flight[key]
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            key = _key(args, kwargs)
+            entry = entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                entries.move_to_end(key)
+                return entry[1]
+
+            task = in_flight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(fn(*args, **kwargs))
+                in_flight[key] = task
+                task.add_done_callback(functools.partial(_forget, key))
+            started_generation = generation
+
+            result = await asyncio.shield(task)
+            if started_generation == generation and task not in invalidated:
+                entries[key] = (time.monotonic() + ttl, result)
+                entries.move_to_end(key)
+                while len(entries) > maxsize:
+                    entries.popitem(last=False)
+            return result
+
+        def cache_clear():
+            nonlocal generation
+            generation += 1
+            entries.clear()
+            in_flight.clear()
+
+        def cache_invalidate(*args, **kwargs):
+            key = _key(args, kwargs)
+            entries.pop(key, None)
+            task = in_flight.pop(key, None)
+            if task is not None:
+                # A call for this key is still running; don't let it (or its waiters) store its result
+                invalidated.add(task)
+
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_invalidate = cache_invalidate
+        return wrapper
+
+    return decorator
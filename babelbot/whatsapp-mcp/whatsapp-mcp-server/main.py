@@ -1,5 +1,10 @@
-from typing import List, Dict, Any, Optional
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
 from mcp.server.fastmcp import FastMCP
+from cache import ttl_cache
 from whatsapp import (
     search_contacts as whatsapp_search_contacts,
     list_messages as whatsapp_list_messages,
@@ -9,27 +14,140 @@ from whatsapp import (
     get_contact_chats as whatsapp_get_contact_chats,
     get_last_interaction as whatsapp_get_last_interaction,
     get_message_context as whatsapp_get_message_context,
+    get_message_contexts as whatsapp_get_message_contexts,
     send_message as whatsapp_send_message,
+    send_messages_bulk as whatsapp_send_messages_bulk,
     send_file as whatsapp_send_file,
     send_audio_message as whatsapp_audio_voice_message,
-    download_media as whatsapp_download_media
+    download_media as whatsapp_download_media,
+    download_media_bulk as whatsapp_download_media_bulk,
+    invalidate_sender_name as whatsapp_invalidate_sender_name
 )
 
 # Initialize FastMCP server
 mcp = FastMCP("whatsapp")
 
+# The next list_messages page, fetched in the background while the caller reads the current
+# one. Keyed on the whatsapp_list_messages arguments; each entry is used at most once and
+# expires quickly so a prefetched page never lags far behind new messages.
+_PREFETCH_TTL = 30
+_PREFETCH_MAXSIZE = 64
+_NEXT_CURSOR_RE = re.compile(r"^Next cursor: (\S+)$", re.MULTILINE)
+_prefetched_pages: OrderedDict[Tuple, Tuple[float, asyncio.Task]] = OrderedDict()
+
+def _prefetch_messages_page(**kwargs) -> None:
+    key = tuple(sorted(kwargs.items()))
+    if key in _prefetched_pages:
+        return
+    task = asyncio.ensure_future(asyncio.to_thread(whatsapp_list_messages, **kwargs))
+    # Retrieve the exception of prefetches nobody claims so it isn't reported as unhandled
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    _prefetched_pages[key] = (time.monotonic() + _PREFETCH_TTL, task)
+    while len(_prefetched_pages) > _PREFETCH_MAXSIZE:
+        _prefetched_pages.popitem(last=False)[1][1].cancel()
+
+def _clear_prefetched_pages() -> None:
+    for _, task in _prefetched_pages.values():
+        task.cancel()
+    _prefetched_pages.clear()
+
+async def _list_messages_page(**kwargs):
+    entry = _prefetched_pages.pop(tuple(sorted(kwargs.items())), None)
+    if entry is not None:
+        if entry[0] > time.monotonic():
+            try:
+                return await entry[1]
+            except Exception:
+                pass
+        else:
+            entry[1].cancel()
+    return await asyncio.to_thread(whatsapp_list_messages, **kwargs)
+
+class MessageContextLoader:
+    """Coalesce get_message_context calls made in the same moment into one batched query.
+
+    Claude often asks for the context of several search hits in one round, and those tool
+    calls arrive concurrently. Each load waits briefly so its siblings can join the batch.
+    """
+
+    def __init__(self, delay: float = 0.002):
+        self.delay = delay
+        # (before, after) -> message_id -> futures waiting for that message's context
+        self._pending: Dict[Tuple[int, int], Dict[str, List[asyncio.Future]]] = {}
+        # Strong references so running dispatches aren't garbage collected
+        self._dispatching: set = set()
+
+    async def load(self, message_id: str, before: int, after: int):
+        key = (before, after)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = {}
+            asyncio.get_running_loop().call_later(self.delay, self._start_dispatch, key)
+        future = asyncio.get_running_loop().create_future()
+        batch.setdefault(message_id, []).append(future)
+        return await future
+
+    def _start_dispatch(self, key: Tuple[int, int]) -> None:
+        task = asyncio.ensure_future(self._dispatch(key))
+        self._dispatching.add(task)
+        task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, key: Tuple[int, int]) -> None:
+        batch = self._pending.pop(key)
+        try:
+            if len(batch) == 1:
+                # Nothing to coalesce; the single-target query is the cheapest plan
+                message_id = next(iter(batch))
+                contexts = {message_id: await asyncio.to_thread(whatsapp_get_message_context, message_id, *key)}
+            else:
+                contexts = await asyncio.to_thread(whatsapp_get_message_contexts, list(batch), *key)
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for message_id, futures in batch.items():
+            for future in futures:
+                if future.done():
+                    continue
+                if message_id in contexts:
+                    future.set_result(contexts[message_id])
+                else:
+                    future.set_exception(ValueError(f"Message with ID {message_id} not found"))
+
+_message_context_loader = MessageContextLoader()
+
+def invalidate_chat_caches(recipient: str) -> None:
+    """Drop cached chat reads after sending, since the chat's last message has changed."""
+    for tool in (list_chats, get_chat, get_direct_chat_by_contact, get_contact_chats):
+        tool.cache_clear()
+    # A new message shifts every page by one
+    _clear_prefetched_pages()
+    # Only the recipient's last interaction changed; a phone number recipient maps to its user JID
+    get_last_interaction.cache_invalidate(recipient)
+    if "@" not in recipient:
+        get_last_interaction.cache_invalidate(f"{recipient}@s.whatsapp.net")
+    # Sending may have created the recipient's chat, so its name can now resolve
+    whatsapp_invalidate_sender_name(recipient)
+
+# The whatsapp module does blocking SQLite and HTTP I/O, so every tool runs it in a worker
+# thread. That way concurrent tool calls overlap instead of serializing on the event loop.
+
 @mcp.tool()
-def search_contacts(query: str) -> List[Dict[str, Any]]:
+@ttl_cache(ttl=30)
+async def search_contacts(query: str) -> List[Dict[str, Any]]:
     """Search WhatsApp contacts by name or phone number.
     
     Args:
         query: Search term to match against contact names or phone numbers
     """
-    contacts = whatsapp_search_contacts(query)
+    contacts = await asyncio.to_thread(whatsapp_search_contacts, query)
     return contacts
 
 @mcp.tool()
-def list_messages(
+async def list_messages(
     after: Optional[str] = None,
     before: Optional[str] = None,
     sender_phone_number: Optional[str] = None,
@@ -39,7 +157,8 @@ def list_messages(
     page: int = 0,
     include_context: bool = True,
     context_before: int = 1,
-    context_after: int = 1
+    context_after: int = 1,
+    cursor: Optional[str] = None
 ) -> List[Dict[str, Any]]:
     """Get WhatsApp messages matching specified criteria with optional context.
     
@@ -50,96 +169,135 @@ def list_messages(
         chat_jid: Optional chat JID to filter messages by chat
         query: Optional search term to filter messages by content
         limit: Maximum number of messages to return (default 20)
-        page: Page number for pagination (default 0)
-        include_context: Whether to include messages before and after matches (default True)
+        page: Deprecated, use cursor instead. Page number for offset pagination (default 0)
+        include_context: Whether to include messages before and after matches (default True).
+            Ignored unless query or sender_phone_number is given, since otherwise the
+            returned messages are already a contiguous slice of history
         context_before: Number of messages to include before each match (default 1)
         context_after: Number of messages to include after each match (default 1)
+        cursor: Optional "Next cursor" value from a previous call to fetch the following page
     """
-    messages = whatsapp_list_messages(
+    effective_context = include_context and bool(query or sender_phone_number)
+    if cursor:
+        # The cursor alone positions the page, so drop page to keep prefetch keys consistent
+        page = 0
+    filters = dict(
         after=after,
         before=before,
         sender_phone_number=sender_phone_number,
         chat_jid=chat_jid,
         query=query,
         limit=limit,
-        page=page,
-        include_context=include_context,
+        include_context=effective_context,
         context_before=context_before,
         context_after=context_after
     )
+    messages = await _list_messages_page(**filters, page=page, page_cursor=cursor)
+
+    # Callers usually page forward with the returned cursor, so start on that page now
+    next_cursor = _NEXT_CURSOR_RE.search(messages) if isinstance(messages, str) else None
+    if next_cursor:
+        _prefetch_messages_page(**filters, page=0, page_cursor=next_cursor.group(1))
     return messages
 
 @mcp.tool()
-def list_chats(
+@ttl_cache(ttl=30)
+async def list_chats(
     query: Optional[str] = None,
     limit: int = 20,
     page: int = 0,
     include_last_message: bool = True,
-    sort_by: str = "last_active"
-) -> List[Dict[str, Any]]:
+    sort_by: str = "last_active",
+    cursor: Optional[str] = None
+) -> Dict[str, Any]:
     """Get WhatsApp chats matching specified criteria.
     
     Args:
         query: Optional search term to filter chats by name or JID
         limit: Maximum number of chats to return (default 20)
-        page: Page number for pagination (default 0)
+        page: Deprecated, use cursor instead. Page number for offset pagination (default 0)
         include_last_message: Whether to include the last message in each chat (default True)
         sort_by: Field to sort results by, either "last_active" or "name" (default "last_active")
+        cursor: Optional next_cursor value from a previous call to fetch the following page
+
+    Returns:
+        A dictionary with the matching chats and the next_cursor for the following page (null on the last page)
     """
-    chats = whatsapp_list_chats(
+    chats, next_cursor = await asyncio.to_thread(
+        whatsapp_list_chats,
         query=query,
         limit=limit,
         page=page,
         include_last_message=include_last_message,
-        sort_by=sort_by
+        sort_by=sort_by,
+        page_cursor=cursor
     )
-    return chats
+    return {
+        "chats": chats,
+        "next_cursor": next_cursor
+    }
 
 @mcp.tool()
-def get_chat(chat_jid: str, include_last_message: bool = True) -> Dict[str, Any]:
+@ttl_cache(ttl=30)
+async def get_chat(chat_jid: str, include_last_message: bool = True) -> Dict[str, Any]:
     """Get WhatsApp chat metadata by JID.
     
     Args:
         chat_jid: The JID of the chat to retrieve
         include_last_message: Whether to include the last message (default True)
     """
-    chat = whatsapp_get_chat(chat_jid, include_last_message)
+    chat = await asyncio.to_thread(whatsapp_get_chat, chat_jid, include_last_message)
     return chat
 
 @mcp.tool()
-def get_direct_chat_by_contact(sender_phone_number: str) -> Dict[str, Any]:
+@ttl_cache(ttl=30)
+async def get_direct_chat_by_contact(sender_phone_number: str) -> Dict[str, Any]:
     """Get WhatsApp chat metadata by sender phone number.
     
     Args:
         sender_phone_number: The phone number to search for
     """
-    chat = whatsapp_get_direct_chat_by_contact(sender_phone_number)
+    chat = await asyncio.to_thread(whatsapp_get_direct_chat_by_contact, sender_phone_number)
     return chat
 
 @mcp.tool()
-def get_contact_chats(jid: str, limit: int = 20, page: int = 0) -> List[Dict[str, Any]]:
+@ttl_cache(ttl=30)
+async def get_contact_chats(
+    jid: str,
+    limit: int = 20,
+    page: int = 0,
+    cursor: Optional[str] = None
+) -> Dict[str, Any]:
     """Get all WhatsApp chats involving the contact.
     
     Args:
         jid: The contact's JID to search for
         limit: Maximum number of chats to return (default 20)
-        page: Page number for pagination (default 0)
+        page: Deprecated, use cursor instead. Page number for offset pagination (default 0)
+        cursor: Optional next_cursor value from a previous call to fetch the following page
+
+    Returns:
+        A dictionary with the matching chats and the next_cursor for the following page (null on the last page)
     """
-    chats = whatsapp_get_contact_chats(jid, limit, page)
-    return chats
+    chats, next_cursor = await asyncio.to_thread(whatsapp_get_contact_chats, jid, limit, page, cursor)
+    return {
+        "chats": chats,
+        "next_cursor": next_cursor
+    }
 
 @mcp.tool()
-def get_last_interaction(jid: str) -> str:
+@ttl_cache(ttl=60)
+async def get_last_interaction(jid: str) -> str:
     """Get most recent WhatsApp message involving the contact.
     
     Args:
         jid: The JID of the contact to search for
     """
-    message = whatsapp_get_last_interaction(jid)
+    message = await asyncio.to_thread(whatsapp_get_last_interaction, jid)
     return message
 
 @mcp.tool()
-def get_message_context(
+async def get_message_context(
     message_id: str,
     before: int = 5,
     after: int = 5
@@ -151,11 +309,11 @@ def get_message_context(
         before: Number of messages to include before the target message (default 5)
         after: Number of messages to include after the target message (default 5)
     """
-    context = whatsapp_get_message_context(message_id, before, after)
+    context = await _message_context_loader.load(message_id, before, after)
     return context
 
 @mcp.tool()
-def send_message(
+async def send_message(
     recipient: str,
     message: str
 ) -> Dict[str, Any]:
@@ -177,14 +335,44 @@ def send_message(
         }
     
     # Call the whatsapp_send_message function with the unified recipient parameter
-    success, status_message = whatsapp_send_message(recipient, message)
+    success, status_message = await asyncio.to_thread(whatsapp_send_message, recipient, message)
+    if success:
+        invalidate_chat_caches(recipient)
     return {
         "success": success,
         "message": status_message
     }
 
 @mcp.tool()
-def send_file(recipient: str, media_path: str) -> Dict[str, Any]:
+async def send_message_bulk(
+    recipients: List[str],
+    message: str
+) -> List[Dict[str, Any]]:
+    """Send the same WhatsApp message to several people or groups at once.
+
+    Args:
+        recipients: The recipients - each either a phone number with country code but no + or other symbols,
+                 or a JID (e.g., "123456789@s.whatsapp.net" or a group JID like "123456789@g.us")
+        message: The message text to send
+    
+    Returns:
+        A list with the recipient, success status and a status message for each recipient
+    """
+    # Already async, so the sends overlap on the event loop instead of occupying worker threads
+    results = await whatsapp_send_messages_bulk(recipients, message)
+    response = []
+    for recipient, (success, status_message) in zip(recipients, results):
+        if success:
+            invalidate_chat_caches(recipient)
+        response.append({
+            "recipient": recipient,
+            "success": success,
+            "message": status_message
+        })
+    return response
+
+@mcp.tool()
+async def send_file(recipient: str, media_path: str) -> Dict[str, Any]:
     """Send a file such as a picture, raw audio, video or document via WhatsApp to the specified recipient. For group messages use the JID.
     
     Args:
@@ -197,14 +385,16 @@ def send_file(recipient: str, media_path: str) -> Dict[str, Any]:
     """
     
     # Call the whatsapp_send_file function
-    success, status_message = whatsapp_send_file(recipient, media_path)
+    success, status_message = await asyncio.to_thread(whatsapp_send_file, recipient, media_path)
+    if success:
+        invalidate_chat_caches(recipient)
     return {
         "success": success,
         "message": status_message
     }
 
 @mcp.tool()
-def send_audio_message(recipient: str, media_path: str) -> Dict[str, Any]:
+async def send_audio_message(recipient: str, media_path: str) -> Dict[str, Any]:
     """Send any audio file as a WhatsApp audio message to the specified recipient. For group messages use the JID. If it errors due to ffmpeg not being installed, use send_file instead.
     
     Args:
@@ -215,14 +405,16 @@ def send_audio_message(recipient: str, media_path: str) -> Dict[str, Any]:
     Returns:
         A dictionary containing success status and a status message
     """
-    success, status_message = whatsapp_audio_voice_message(recipient, media_path)
+    success, status_message = await asyncio.to_thread(whatsapp_audio_voice_message, recipient, media_path)
+    if success:
+        invalidate_chat_caches(recipient)
     return {
         "success": success,
         "message": status_message
     }
 
 @mcp.tool()
-def download_media(message_id: str, chat_jid: str) -> Dict[str, Any]:
+async def download_media(message_id: str, chat_jid: str) -> Dict[str, Any]:
     """Download media from a WhatsApp message and get the local file path.
     
     Args:
@@ -232,7 +424,7 @@ def download_media(message_id: str, chat_jid: str) -> Dict[str, Any]:
     Returns:
         A dictionary containing success status, a status message, and the file path if successful
     """
-    file_path = whatsapp_download_media(message_id, chat_jid)
+    file_path = await asyncio.to_thread(whatsapp_download_media, message_id, chat_jid)
     
     if file_path:
         return {
@@ -246,6 +438,28 @@ def download_media(message_id: str, chat_jid: str) -> Dict[str, Any]:
             "message": "Failed to download media"
         }
 
+@mcp.tool()
+async def download_media_bulk(media: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """Download media from several WhatsApp messages at once and get the local file paths.
+    
+    Args:
+        media: The messages to download, each a dictionary with the "message_id" of the message
+               containing the media and the "chat_jid" of the chat containing it
+    
+    Returns:
+        A list with the message ID, success status and file path if successful for each message, in the order given
+    """
+    pairs = [(item["message_id"], item["chat_jid"]) for item in media]
+    file_paths = await asyncio.to_thread(whatsapp_download_media_bulk, pairs)
+    return [
+        {
+            "message_id": message_id,
+            "success": file_path is not None,
+            "file_path": file_path
+        }
+        for (message_id, _), file_path in zip(pairs, file_paths)
+    ]
+
 if __name__ == "__main__":
     # Initialize and run the server
     mcp.run(transport='stdio')
\ No newline at end of file
@@ -1,16 +1,124 @@
+import asyncio
+import atexit
+import base64
+import logging
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from io import StringIO
 from dataclasses import dataclass
-from typing import Optional, List, Tuple
+from typing import Dict, Iterable, Optional, List, Tuple
 import os.path
+import re
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import audio
 
+try:
+    # C parser, several times faster than the stdlib on the per-row timestamp parsing below
+    from ciso8601 import parse_datetime as _parse_timestamp
+except ImportError:
+    _parse_timestamp = datetime.fromisoformat
+
+# stdout carries the MCP JSON-RPC stream, so diagnostics must go through logging (stderr)
+logger = logging.getLogger(__name__)
+
 MESSAGES_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'whatsapp-bridge', 'store', 'messages.db')
 WHATSAPP_API_BASE_URL = "http://localhost:8080/api"
 
-@dataclass
+# Keep-alive connections to the bridge, shared by all send/download calls. Retry only covers
+# failures to connect (urllib3 doesn't retry POST reads), so a message is never sent twice.
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=2, backoff_factor=0.1)))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=2, backoff_factor=0.1)))
+atexit.register(_SESSION.close)
+# (connect, read) timeouts; the bridge uploads media to WhatsApp before it responds
+_REQUEST_TIMEOUT = (3, 60)
+
+# Compiled once at import; send paths are hot during bursts
+_JID_RE = re.compile(r"^[\d-]+@(s\.whatsapp\.net|g\.us|lid)$")
+_PHONE_RE = re.compile(r"^\d{7,15}$")
+
+# Sender JID -> (expires_at, display name). Names repeat heavily across a page of messages,
+# and tools run in worker threads, so access is guarded by a lock.
+_SENDER_NAME_TTL = 300
+_SENDER_NAME_MAXSIZE = 4096
+_sender_names: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+_sender_names_lock = threading.Lock()
+
+# One long-lived connection per thread instead of a connect/close round-trip per query
+_thread_local = threading.local()
+_connections: List[sqlite3.Connection] = []
+
+def _get_db() -> sqlite3.Connection:
+    """Return this thread's connection to the messages database, opening it on first use."""
+    conn = getattr(_thread_local, "conn", None)
+    if conn is None:
+        # check_same_thread=False only so the atexit hook can close every thread's connection
+        conn = sqlite3.connect(MESSAGES_DB_PATH, check_same_thread=False)
+        _thread_local.conn = conn
+        _connections.append(conn)
+    return conn
+
+@atexit.register
+def _close_connections() -> None:
+    for conn in _connections:
+        conn.close()
+
+# Joins each chat (aliased c) to its latest message (aliased m) with a top-1 seek on
+# idx_messages_chat_timestamp, rather than matching every message on last_message_time
+_LAST_MESSAGE_JOIN = """
+    LEFT JOIN messages m ON m.rowid = (
+        SELECT rowid
+        FROM messages
+        WHERE chat_jid = c.jid
+        ORDER BY timestamp DESC
+        LIMIT 1
+    )
+"""
+
+def _validate_recipient(recipient: str) -> Optional[str]:
+    """Return an error message if the recipient is neither a JID nor a bare phone number."""
+    if not recipient:
+        return "Recipient must be provided"
+    # The bridge treats anything containing "@" as a JID, so only check the matching pattern
+    pattern = _JID_RE if "@" in recipient else _PHONE_RE
+    if not pattern.match(recipient):
+        return f"Invalid recipient: {recipient}"
+    return None
+
+# Larger pages are clamped; deep offset pages are rejected in favour of cursors
+_MAX_LIMIT = 200
+_MAX_OFFSET = 10_000
+
+def _check_page_bounds(limit: int, page: int) -> Tuple[int, int]:
+    """Clamp limit to [1, _MAX_LIMIT] and page to >= 0, rejecting offsets past _MAX_OFFSET."""
+    limit = max(1, min(limit, _MAX_LIMIT))
+    page = max(0, page)
+    if page * limit > _MAX_OFFSET:
+        raise ValueError(
+            f"Page {page} is too deep for offset pagination; use the cursor from the previous page instead"
+        )
+    return limit, page
+
+def _encode_cursor(sort_key: str, row_id: str) -> str:
+    """Encode the sort key and id of the last row of a page as an opaque keyset cursor."""
+    return base64.urlsafe_b64encode(json.dumps({"key": sort_key, "id": row_id}).encode()).decode()
+
+def _decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return data["key"], data["id"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+@dataclass(slots=True)
 class Message:
     timestamp: datetime
     sender: str
@@ -21,7 +129,7 @@ class Message:
     chat_name: Optional[str] = None
     media_type: Optional[str] = None
 
-@dataclass
+@dataclass(slots=True)
 class Chat:
     jid: str
     name: Optional[str]
@@ -35,21 +143,58 @@ class Chat:
         """Determine if chat is a group based on JID pattern."""
         return self.jid.endswith("@g.us")
 
-@dataclass
+@dataclass(slots=True)
 class Contact:
     phone_number: str
     name: Optional[str]
     jid: str
 
-@dataclass
+@dataclass(slots=True)
 class MessageContext:
     message: Message
     before: List[Message]
     after: List[Message]
 
+def _cached_sender_name(sender_jid: str) -> Optional[str]:
+    with _sender_names_lock:
+        entry = _sender_names.get(sender_jid)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del _sender_names[sender_jid]
+            return None
+        _sender_names.move_to_end(sender_jid)
+        return entry[1]
+
+def _cache_sender_name(sender_jid: str, name: str) -> None:
+    with _sender_names_lock:
+        _sender_names[sender_jid] = (time.monotonic() + _SENDER_NAME_TTL, name)
+        _sender_names.move_to_end(sender_jid)
+        while len(_sender_names) > _SENDER_NAME_MAXSIZE:
+            _sender_names.popitem(last=False)
+
+def invalidate_sender_name(sender_jid: str) -> None:
+    """Forget the cached display name of a sender, e.g. after its chat was renamed.
+
+    Senders are stored as bare phone numbers and chats by JID, so both forms are dropped.
+    """
+    phone_part = sender_jid.split('@')[0]
+    with _sender_names_lock:
+        for jid in (sender_jid, phone_part, f"{phone_part}@s.whatsapp.net"):
+            _sender_names.pop(jid, None)
+
 def get_sender_name(sender_jid: str) -> str:
+    name = _cached_sender_name(sender_jid)
+    if name is None:
+        name = _lookup_sender_name(sender_jid)
+        if name is None:
+            return sender_jid
+        _cache_sender_name(sender_jid, name)
+    return name
+
+def _lookup_sender_name(sender_jid: str) -> Optional[str]:
     try:
-        conn = sqlite3.connect(MESSAGES_DB_PATH)
+        conn = _get_db()
         cursor = conn.cursor()
         
         # First try matching by exact JID
@@ -62,7 +207,7 @@ def get_sender_name(sender_jid: str) -> str:
         
         result = cursor.fetchone()
         
-        # If no result, try looking for the number within JIDs
+        # If no result, match the number against the user part of chat JIDs
         if not result:
             # Extract the phone number part if it's a JID
             if '@' in sender_jid:
@@ -70,56 +215,133 @@ def get_sender_name(sender_jid: str) -> str:
             else:
                 phone_part = sender_jid
                 
+            # Equality on the same expression as the bridge's idx_chats_phone index, not a LIKE scan
             cursor.execute("""
                 SELECT name
                 FROM chats
-                WHERE jid LIKE ?
+                WHERE substr(jid, 1, instr(jid, '@') - 1) = ?
                 LIMIT 1
-            """, (f"%{phone_part}%",))
+            """, (phone_part,))
             
             result = cursor.fetchone()
         
-        if result and result[0]:
-            return result[0]
-        else:
-            return sender_jid
+        # Misses aren't cached, so a contact the bridge adds later shows up by name right away
+        return result[0] if result and result[0] else None
         
     except sqlite3.Error as e:
+        # Not cached, so the lookup is retried once the database is readable again
         print(f"Database error while getting sender name: {e}")
-        return sender_jid
-    finally:
-        if 'conn' in locals():
-            conn.close()
+        return None
+
+def resolve_sender_names(sender_jids: Iterable[str]) -> Dict[str, str]:
+    """Resolve many senders to display names with one query instead of one lookup per message.
+
+    Senders are matched by exact JID, and bare phone numbers (as the bridge stores them) also
+    by their user JID. Anything still unresolved falls back to get_sender_name.
+    """
+    names = {}
+    unique_jids = set()
+    for jid in set(sender_jids):
+        name = _cached_sender_name(jid)
+        if name is None:
+            unique_jids.add(jid)
+        else:
+            names[jid] = name
+    if not unique_jids:
+        return names
+
+    candidates = {jid: jid for jid in unique_jids}
+    for jid in unique_jids:
+        if '@' not in jid:
+            candidates[f"{jid}@s.whatsapp.net"] = jid
+
+    resolved = {}
+    try:
+        conn = _get_db()
+        cursor = conn.cursor()
+        placeholders = ", ".join("?" for _ in candidates)
+        cursor.execute(f"""
+            SELECT jid, name
+            FROM chats
+            WHERE jid IN ({placeholders})
+        """, tuple(candidates))
+        for jid, name in cursor.fetchall():
+            sender_jid = candidates[jid]
+            # An exact match wins over the user JID derived from a bare number; unnamed chats
+            # are left to get_sender_name, which doesn't cache misses
+            if name and (jid == sender_jid or sender_jid not in resolved):
+                resolved[sender_jid] = name
+    except sqlite3.Error as e:
+        logger.error("Database error while resolving sender names: %s", e)
+
+    for jid, name in resolved.items():
+        _cache_sender_name(jid, name)
+        names[jid] = name
+    for jid in unique_jids - resolved.keys():
+        names[jid] = get_sender_name(jid)
+    return names
 
-def format_message(message: Message, show_chat_info: bool = True) -> None:
+def _format_timestamp(timestamp: datetime) -> str:
+    """Format as "%Y-%m-%d %H:%M:%S"; isoformat is about twice as fast as strftime."""
+    return timestamp.isoformat(" ", "seconds")[:19]
+
+def format_message(
+    message: Message,
+    show_chat_info: bool = True,
+    sender_names: Optional[Dict[str, str]] = None
+) -> None:
     """Print a single message with consistent formatting."""
-    output = ""
+    parts = ["[", _format_timestamp(message.timestamp), "] "]
     
     if show_chat_info and message.chat_name:
-        output += f"[{message.timestamp:%Y-%m-%d %H:%M:%S}] Chat: {message.chat_name} "
-    else:
-        output += f"[{message.timestamp:%Y-%m-%d %H:%M:%S}] "
-        
-    content_prefix = ""
-    if hasattr(message, 'media_type') and message.media_type:
-        content_prefix = f"[{message.media_type} - Message ID: {message.id} - Chat JID: {message.chat_jid}] "
+        parts += ["Chat: ", message.chat_name, " "]
     
     try:
-        sender_name = get_sender_name(message.sender) if not message.is_from_me else "Me"
-        output += f"From: {sender_name}: {content_prefix}{message.content}\n"
+        if message.is_from_me:
+            sender_name = "Me"
+        elif sender_names is not None and message.sender in sender_names:
+            sender_name = sender_names[message.sender]
+        else:
+            sender_name = get_sender_name(message.sender)
+        parts += ["From: ", sender_name, ": "]
+        if message.media_type:
+            parts.append(f"[{message.media_type} - Message ID: {message.id} - Chat JID: {message.chat_jid}] ")
+        parts += [str(message.content), "\n"]
     except Exception as e:
         print(f"Error formatting message: {e}")
-    return output
+    return "".join(parts)
 
-def format_messages_list(messages: List[Message], show_chat_info: bool = True) -> None:
-    output = ""
-    if not messages:
-        output += "No messages to display."
-        return output
-    
+def format_messages_list(
+    messages: Iterable[Message],
+    show_chat_info: bool = True,
+    sender_names: Optional[Dict[str, str]] = None
+) -> None:
+    """Format messages one at a time as they are produced.
+
+    Without sender_names the messages are materialized once to resolve all senders up front;
+    pass them in to stream a lazy iterable straight into the output.
+    """
+    if sender_names is None:
+        messages = list(messages)
+        sender_names = resolve_sender_names(message.sender for message in messages if not message.is_from_me)
+
+    output = StringIO()
     for message in messages:
-        output += format_message(message, show_chat_info)
-    return output
+        output.write(format_message(message, show_chat_info, sender_names))
+    return output.getvalue() or "No messages to display."
+
+def _message_from_row(row: Tuple) -> Message:
+    """Build a Message from a (timestamp, sender, chat name, content, is_from_me, chat jid, id, media_type) row."""
+    return Message(
+        timestamp=_parse_timestamp(row[0]),
+        sender=row[1],
+        chat_name=row[2],
+        content=row[3],
+        is_from_me=row[4],
+        chat_jid=row[5],
+        id=row[6],
+        media_type=row[7]
+    )
 
 def list_messages(
     after: Optional[str] = None,
@@ -131,11 +353,17 @@ def list_messages(
     page: int = 0,
     include_context: bool = True,
     context_before: int = 1,
-    context_after: int = 1
+    context_after: int = 1,
+    page_cursor: Optional[str] = None
 ) -> List[Message]:
-    """Get messages matching the specified criteria with optional context."""
+    """Get messages matching the specified criteria with optional context.
+
+    Pages are fetched with `page_cursor` (keyset pagination) when given, otherwise with the
+    deprecated `page` offset. A "Next cursor" line is appended when more messages may follow.
+    """
+    limit, page = _check_page_bounds(limit, page)
     try:
-        conn = sqlite3.connect(MESSAGES_DB_PATH)
+        conn = _get_db()
         cursor = conn.cursor()
         
         # Build base query
@@ -172,55 +400,98 @@ def list_messages(
             params.append(chat_jid)
             
         if query:
-            where_clauses.append("LOWER(messages.content) LIKE LOWER(?)")
+            # SQLite's LIKE is already case-insensitive for ASCII, so no LOWER() per row
+            where_clauses.append("messages.content LIKE ?")
             params.append(f"%{query}%")
+
+        if page_cursor:
+            # Seek past the last row of the previous page instead of scanning and skipping an offset
+            where_clauses.append("(messages.timestamp, messages.id) < (?, ?)")
+            params.extend(_decode_cursor(page_cursor))
             
         if where_clauses:
             query_parts.append("WHERE " + " AND ".join(where_clauses))
             
         # Add pagination
-        offset = page * limit
-        query_parts.append("ORDER BY messages.timestamp DESC")
-        query_parts.append("LIMIT ? OFFSET ?")
-        params.extend([limit, offset])
+        query_parts.append("ORDER BY messages.timestamp DESC, messages.id DESC")
+        if page_cursor:
+            query_parts.append("LIMIT ?")
+            params.append(limit)
+        else:
+            query_parts.append("LIMIT ? OFFSET ?")
+            params.extend([limit, page * limit])
         
         cursor.execute(" ".join(query_parts), tuple(params))
-        messages = cursor.fetchall()
-        
-        result = []
-        for msg in messages:
-            message = Message(
-                timestamp=datetime.fromisoformat(msg[0]),
-                sender=msg[1],
-                chat_name=msg[2],
-                content=msg[3],
-                is_from_me=msg[4],
-                chat_jid=msg[5],
-                id=msg[6],
-                media_type=msg[7]
-            )
-            result.append(message)
+        rows = cursor.fetchall()
+        next_cursor = _encode_cursor(rows[-1][0], rows[-1][6]) if len(rows) == limit else None
             
-        if include_context and result:
-            # Add context for each message
-            messages_with_context = []
-            for msg in result:
-                context = get_message_context(msg.id, context_before, context_after)
-                messages_with_context.extend(context.before)
-                messages_with_context.append(context.message)
-                messages_with_context.extend(context.after)
-            
-            return format_messages_list(messages_with_context, show_chat_info=True)
-            
-        # Format and display messages without context
-        return format_messages_list(result, show_chat_info=True)    
+        if include_context and rows:
+            # Fetch the context of every match in one windowed query instead of three per match
+            rows = _list_messages_with_context(cursor, rows, context_before, context_after)
+
+        # Senders are resolved from the raw rows, so Message objects are built lazily while formatting
+        sender_names = resolve_sender_names(row[1] for row in rows if not row[4])
+        output = format_messages_list(map(_message_from_row, rows), show_chat_info=True, sender_names=sender_names)
+
+        if next_cursor:
+            output += f"Next cursor: {next_cursor}\n"
+        return output
         
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return []
-    finally:
-        if 'conn' in locals():
-            conn.close()
+
+
+def _list_messages_with_context(
+    cursor: sqlite3.Cursor,
+    matches: List[Tuple],
+    before: int,
+    after: int
+) -> List[Tuple]:
+    """Return the rows of each match surrounded by its chat neighbours, in match order.
+
+    Like get_message_context, the messages before a match come newest first, followed by the
+    match and then the messages after it, oldest first.
+    """
+    values = ", ".join("(?, ?, ?, ?)" for _ in matches)
+    params = [value for pos, row in enumerate(matches) for value in (pos, row[6], row[5], row[0])]
+    # Each match's neighbours come from LIMIT seeks on the (chat_jid, timestamp) index, so the
+    # cost grows with the context size rather than with the size of the matched chats
+    cursor.execute(f"""
+        WITH matches(pos, id, chat_jid, timestamp) AS (VALUES {values}),
+        picked AS (
+            SELECT matches.pos, 0 AS part, m.rowid AS row_id
+            FROM matches
+            JOIN messages m ON m.rowid IN (
+                SELECT rowid FROM messages
+                WHERE chat_jid = matches.chat_jid AND (timestamp, id) < (matches.timestamp, matches.id)
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            )
+            UNION ALL
+            SELECT matches.pos, 1, m.rowid
+            FROM matches
+            JOIN messages m ON m.id = matches.id AND m.chat_jid = matches.chat_jid
+            UNION ALL
+            SELECT matches.pos, 2, m.rowid
+            FROM matches
+            JOIN messages m ON m.rowid IN (
+                SELECT rowid FROM messages
+                WHERE chat_jid = matches.chat_jid AND (timestamp, id) > (matches.timestamp, matches.id)
+                ORDER BY timestamp, id
+                LIMIT ?
+            )
+        )
+        SELECT r.timestamp, r.sender, chats.name, r.content, r.is_from_me, chats.jid, r.id, r.media_type
+        FROM picked
+        JOIN messages r ON r.rowid = picked.row_id
+        JOIN chats ON r.chat_jid = chats.jid
+        ORDER BY picked.pos, picked.part,
+            CASE WHEN picked.part = 0 THEN r.timestamp END DESC,
+            CASE WHEN picked.part = 0 THEN r.id END DESC,
+            r.timestamp, r.id
+    """, (*params, before, after))
+    return cursor.fetchall()
 
 
 def get_message_context(
@@ -230,77 +501,64 @@ def get_message_context(
 ) -> MessageContext:
     """Get context around a specific message."""
     try:
-        conn = sqlite3.connect(MESSAGES_DB_PATH)
+        conn = _get_db()
         cursor = conn.cursor()
         
-        # Get the target message first
-        cursor.execute("""
-            SELECT messages.timestamp, messages.sender, chats.name, messages.content, messages.is_from_me, chats.jid, messages.id, messages.chat_jid, messages.media_type
-            FROM messages
-            JOIN chats ON messages.chat_jid = chats.jid
-            WHERE messages.id = ?
-        """, (message_id,))
-        msg_data = cursor.fetchone()
-        
-        if not msg_data:
-            raise ValueError(f"Message with ID {message_id} not found")
-            
-        target_message = Message(
-            timestamp=datetime.fromisoformat(msg_data[0]),
-            sender=msg_data[1],
-            chat_name=msg_data[2],
-            content=msg_data[3],
-            is_from_me=msg_data[4],
-            chat_jid=msg_data[5],
-            id=msg_data[6],
-            media_type=msg_data[8]
-        )
-        
-        # Get messages before
+        # Fetch the target and its neighbours in one statement; pos says which part each row is
         cursor.execute("""
-            SELECT messages.timestamp, messages.sender, chats.name, messages.content, messages.is_from_me, chats.jid, messages.id, messages.media_type
-            FROM messages
-            JOIN chats ON messages.chat_jid = chats.jid
-            WHERE messages.chat_jid = ? AND messages.timestamp < ?
-            ORDER BY messages.timestamp DESC
-            LIMIT ?
-        """, (msg_data[7], msg_data[0], before))
+            WITH target AS (
+                SELECT rowid AS row_id, chat_jid, timestamp
+                FROM messages
+                WHERE id = ?
+                LIMIT 1
+            )
+            SELECT * FROM (
+                SELECT 'before' AS pos, m.timestamp, m.sender, chats.name, m.content, m.is_from_me, chats.jid, m.id, m.media_type
+                FROM target
+                JOIN messages m ON m.chat_jid = target.chat_jid AND m.timestamp < target.timestamp
+                JOIN chats ON m.chat_jid = chats.jid
+                ORDER BY m.timestamp DESC
+                LIMIT ?
+            )
+            UNION ALL
+            SELECT 'target', m.timestamp, m.sender, chats.name, m.content, m.is_from_me, chats.jid, m.id, m.media_type
+            FROM target
+            JOIN messages m ON m.rowid = target.row_id
+            JOIN chats ON m.chat_jid = chats.jid
+            UNION ALL
+            SELECT * FROM (
+                SELECT 'after', m.timestamp, m.sender, chats.name, m.content, m.is_from_me, chats.jid, m.id, m.media_type
+                FROM target
+                JOIN messages m ON m.chat_jid = target.chat_jid AND m.timestamp > target.timestamp
+                JOIN chats ON m.chat_jid = chats.jid
+                ORDER BY m.timestamp ASC
+                LIMIT ?
+            )
+        """, (message_id, before, after))
         
+        target_message = None
         before_messages = []
-        for msg in cursor.fetchall():
-            before_messages.append(Message(
-                timestamp=datetime.fromisoformat(msg[0]),
-                sender=msg[1],
-                chat_name=msg[2],
-                content=msg[3],
-                is_from_me=msg[4],
-                chat_jid=msg[5],
-                id=msg[6],
-                media_type=msg[7]
-            ))
-        
-        # Get messages after
-        cursor.execute("""
-            SELECT messages.timestamp, messages.sender, chats.name, messages.content, messages.is_from_me, chats.jid, messages.id, messages.media_type
-            FROM messages
-            JOIN chats ON messages.chat_jid = chats.jid
-            WHERE messages.chat_jid = ? AND messages.timestamp > ?
-            ORDER BY messages.timestamp ASC
-            LIMIT ?
-        """, (msg_data[7], msg_data[0], after))
-        
         after_messages = []
         for msg in cursor.fetchall():
-            after_messages.append(Message(
-                timestamp=datetime.fromisoformat(msg[0]),
-                sender=msg[1],
-                chat_name=msg[2],
-                content=msg[3],
-                is_from_me=msg[4],
-                chat_jid=msg[5],
-                id=msg[6],
-                media_type=msg[7]
-            ))
+            message = Message(
+                timestamp=_parse_timestamp(msg[1]),
+                sender=msg[2],
+                chat_name=msg[3],
+                content=msg[4],
+                is_from_me=msg[5],
+                chat_jid=msg[6],
+                id=msg[7],
+                media_type=msg[8]
+            )
+            if msg[0] == 'before':
+                before_messages.append(message)
+            elif msg[0] == 'after':
+                after_messages.append(message)
+            else:
+                target_message = message
+        
+        if target_message is None:
+            raise ValueError(f"Message with ID {message_id} not found")
         
         return MessageContext(
             message=target_message,
@@ -311,9 +569,82 @@ def get_message_context(
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         raise
-    finally:
-        if 'conn' in locals():
-            conn.close()
+
+
+def get_message_contexts(
+    message_ids: List[str],
+    before: int = 5,
+    after: int = 5
+) -> Dict[str, MessageContext]:
+    """Get the context around several messages with one query.
+
+    Returns:
+        The context of each message that was found, keyed by message ID
+    """
+    if not message_ids:
+        return {}
+    try:
+        conn = _get_db()
+        cursor = conn.cursor()
+        
+        values = ", ".join("(?)" for _ in message_ids)
+        # Same semantics as get_message_context: each target's neighbours are picked by a
+        # LIMIT seek on the (chat_jid, timestamp) index rather than by numbering its whole chat
+        cursor.execute(f"""
+            WITH target_ids(id) AS (VALUES {values}),
+            targets AS (
+                SELECT id, chat_jid, timestamp, rowid AS row_id
+                FROM messages
+                WHERE id IN (SELECT id FROM target_ids)
+                GROUP BY id
+            ),
+            neighbours AS (
+                SELECT t.id AS target_id, 0 AS pos, m.rowid AS row_id
+                FROM targets t
+                JOIN messages m ON m.rowid IN (
+                    SELECT rowid FROM messages
+                    WHERE chat_jid = t.chat_jid AND timestamp < t.timestamp
+                    ORDER BY timestamp DESC
+                    LIMIT ?
+                )
+                UNION ALL
+                SELECT t.id, 1, t.row_id
+                FROM targets t
+                UNION ALL
+                SELECT t.id, 2, m.rowid
+                FROM targets t
+                JOIN messages m ON m.rowid IN (
+                    SELECT rowid FROM messages
+                    WHERE chat_jid = t.chat_jid AND timestamp > t.timestamp
+                    ORDER BY timestamp ASC
+                    LIMIT ?
+                )
+            )
+            SELECT nb.target_id, nb.pos, m.timestamp, m.sender, chats.name, m.content, m.is_from_me, chats.jid, m.id, m.media_type
+            FROM neighbours nb
+            JOIN messages m ON m.rowid = nb.row_id
+            JOIN chats ON m.chat_jid = chats.jid
+            ORDER BY nb.target_id, nb.pos, CASE WHEN nb.pos = 0 THEN m.timestamp END DESC, m.timestamp
+        """, (*message_ids, before, after))
+        
+        contexts: Dict[str, MessageContext] = {}
+        for row in cursor.fetchall():
+            target_id, pos = row[0], row[1]
+            message = _message_from_row(row[2:])
+            context = contexts.get(target_id)
+            if context is None:
+                context = contexts[target_id] = MessageContext(message=None, before=[], after=[])
+            if pos == 0:
+                context.before.append(message)
+            elif pos == 2:
+                context.after.append(message)
+            else:
+                context.message = message
+        return contexts
+        
+    except sqlite3.Error as e:
+        logger.error("Database error while loading message contexts: %s", e)
+        raise
 
 
 def list_chats(
@@ -321,91 +652,116 @@ def list_chats(
     limit: int = 20,
     page: int = 0,
     include_last_message: bool = True,
-    sort_by: str = "last_active"
-) -> List[Chat]:
-    """Get chats matching the specified criteria."""
+    sort_by: str = "last_active",
+    page_cursor: Optional[str] = None
+) -> Tuple[List[Chat], Optional[str]]:
+    """Get chats matching the specified criteria.
+
+    Pages are fetched with `page_cursor` (keyset pagination) when given, otherwise with the
+    deprecated `page` offset.
+
+    Returns:
+        The chats and the cursor for the next page, or None if this was the last page
+    """
+    limit, page = _check_page_bounds(limit, page)
     try:
-        conn = sqlite3.connect(MESSAGES_DB_PATH)
+        conn = _get_db()
         cursor = conn.cursor()
         
         # Build base query
-        query_parts = ["""
+        last_message_columns = "m.content, m.sender, m.is_from_me" if include_last_message else "NULL, NULL, NULL"
+        query_parts = [f"""
             SELECT 
-                chats.jid,
-                chats.name,
-                chats.last_message_time,
-                messages.content as last_message,
-                messages.sender as last_sender,
-                messages.is_from_me as last_is_from_me
-            FROM chats
+                c.jid,
+                c.name,
+                c.last_message_time,
+                {last_message_columns}
+            FROM chats c
         """]
         
         if include_last_message:
-            query_parts.append("""
-                LEFT JOIN messages ON chats.jid = messages.chat_jid 
-                AND chats.last_message_time = messages.timestamp
-            """)
+            query_parts.append(_LAST_MESSAGE_JOIN)
             
         where_clauses = []
         params = []
         
         if query:
-            where_clauses.append("(LOWER(chats.name) LIKE LOWER(?) OR chats.jid LIKE ?)")
+            where_clauses.append("(c.name LIKE ? OR c.jid LIKE ?)")
             params.extend([f"%{query}%", f"%{query}%"])
+
+        # The jid tiebreaker makes the sort order total, which keyset pagination relies on
+        if sort_by == "last_active":
+            sort_key = "COALESCE(c.last_message_time, '')"
+            order_by = f"{sort_key} DESC, c.jid DESC"
+            seek = f"({sort_key}, c.jid) < (?, ?)"
+        else:
+            sort_key = "COALESCE(c.name, '')"
+            order_by = f"{sort_key}, c.jid"
+            seek = f"({sort_key}, c.jid) > (?, ?)"
+
+        if page_cursor:
+            where_clauses.append(seek)
+            params.extend(_decode_cursor(page_cursor))
             
         if where_clauses:
             query_parts.append("WHERE " + " AND ".join(where_clauses))
             
         # Add sorting
-        order_by = "chats.last_message_time DESC" if sort_by == "last_active" else "chats.name"
         query_parts.append(f"ORDER BY {order_by}")
         
         # Add pagination
-        offset = (page ) * limit
-        query_parts.append("LIMIT ? OFFSET ?")
-        params.extend([limit, offset])
+        if page_cursor:
+            query_parts.append("LIMIT ?")
+            params.append(limit)
+        else:
+            query_parts.append("LIMIT ? OFFSET ?")
+            params.extend([limit, page * limit])
         
         cursor.execute(" ".join(query_parts), tuple(params))
         chats = cursor.fetchall()
+
+        next_cursor = None
+        if len(chats) == limit:
+            last = chats[-1]
+            last_sort_value = last[2] if sort_by == "last_active" else last[1]
+            next_cursor = _encode_cursor(last_sort_value or "", last[0])
         
         result = []
         for chat_data in chats:
             chat = Chat(
                 jid=chat_data[0],
                 name=chat_data[1],
-                last_message_time=datetime.fromisoformat(chat_data[2]) if chat_data[2] else None,
+                last_message_time=_parse_timestamp(chat_data[2]) if chat_data[2] else None,
                 last_message=chat_data[3],
                 last_sender=chat_data[4],
                 last_is_from_me=chat_data[5]
             )
             result.append(chat)
             
-        return result
+        return result, next_cursor
         
     except sqlite3.Error as e:
         print(f"Database error: {e}")
-        return []
-    finally:
-        if 'conn' in locals():
-            conn.close()
+        return [], None
 
 
 def search_contacts(query: str) -> List[Contact]:
     """Search contacts by name or phone number."""
     try:
-        conn = sqlite3.connect(MESSAGES_DB_PATH)
+        conn = _get_db()
         cursor = conn.cursor()
         
         # Split query into characters to support partial matching
         search_pattern = '%' +query + '%'
         
+        # jid is the primary key, so DISTINCT only added a sort; LIKE is case-insensitive already
         cursor.execute("""
-            SELECT DISTINCT 
+            SELECT
                 jid,
                 name
             FROM chats
             WHERE 
-                (LOWER(name) LIKE LOWER(?) OR LOWER(jid) LIKE LOWER(?))
+                (name LIKE ? OR jid LIKE ?)
                 AND jid NOT LIKE '%@g.us'
             ORDER BY name, jid
             LIMIT 50
@@ -427,25 +783,44 @@ def search_contacts(query: str) -> List[Contact]:
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return []
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 
-def get_contact_chats(jid: str, limit: int = 20, page: int = 0) -> List[Chat]:
+def get_contact_chats(
+    jid: str,
+    limit: int = 20,
+    page: int = 0,
+    page_cursor: Optional[str] = None
+) -> Tuple[List[Chat], Optional[str]]:
     """Get all chats involving the contact.
     
     Args:
         jid: The contact's JID to search for
         limit: Maximum number of chats to return (default 20)
-        page: Page number for pagination (default 0)
+        page: Deprecated offset page number, used only when no page_cursor is given (default 0)
+        page_cursor: Keyset cursor returned by the previous page
+
+    Returns:
+        The chats and the cursor for the next page, or None if this was the last page
     """
+    limit, page = _check_page_bounds(limit, page)
     try:
-        conn = sqlite3.connect(MESSAGES_DB_PATH)
+        conn = _get_db()
         cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT DISTINCT
+        params = [jid, jid]
+        seek = ""
+        if page_cursor:
+            seek = "AND (COALESCE(c.last_message_time, ''), c.jid) < (?, ?)"
+            params.extend(_decode_cursor(page_cursor))
+            pagination = "LIMIT ?"
+            params.append(limit)
+        else:
+            pagination = "LIMIT ? OFFSET ?"
+            params.extend([limit, page * limit])
+
+        # One row per chat: filter chats by membership first, then join only each chat's last message
+        cursor.execute(f"""
+            SELECT
                 c.jid,
                 c.name,
                 c.last_message_time,
@@ -453,56 +828,62 @@ def get_contact_chats(jid: str, limit: int = 20, page: int = 0) -> List[Chat]:
                 m.sender as last_sender,
                 m.is_from_me as last_is_from_me
             FROM chats c
-            JOIN messages m ON c.jid = m.chat_jid
-            WHERE m.sender = ? OR c.jid = ?
-            ORDER BY c.last_message_time DESC
-            LIMIT ? OFFSET ?
-        """, (jid, jid, limit, page * limit))
+            {_LAST_MESSAGE_JOIN}
+            WHERE (c.jid = ? OR c.jid IN (SELECT chat_jid FROM messages WHERE sender = ?)) {seek}
+            ORDER BY COALESCE(c.last_message_time, '') DESC, c.jid DESC
+            {pagination}
+        """, tuple(params))
         
         chats = cursor.fetchall()
+        next_cursor = _encode_cursor(chats[-1][2] or "", chats[-1][0]) if len(chats) == limit else None
         
         result = []
         for chat_data in chats:
             chat = Chat(
                 jid=chat_data[0],
                 name=chat_data[1],
-                last_message_time=datetime.fromisoformat(chat_data[2]) if chat_data[2] else None,
+                last_message_time=_parse_timestamp(chat_data[2]) if chat_data[2] else None,
                 last_message=chat_data[3],
                 last_sender=chat_data[4],
                 last_is_from_me=chat_data[5]
             )
             result.append(chat)
             
-        return result
+        return result, next_cursor
         
     except sqlite3.Error as e:
         print(f"Database error: {e}")
-        return []
-    finally:
-        if 'conn' in locals():
-            conn.close()
+        return [], None
 
 
 def get_last_interaction(jid: str) -> str:
     """Get most recent message involving the contact."""
     try:
-        conn = sqlite3.connect(MESSAGES_DB_PATH)
+        conn = _get_db()
         cursor = conn.cursor()
         
+        # Newest message sent by the contact and newest in their chat, each an index seek, then
+        # the later of the two. No join: the chat name comes from the sender name cache below.
         cursor.execute("""
-            SELECT 
-                m.timestamp,
-                m.sender,
-                c.name,
-                m.content,
-                m.is_from_me,
-                c.jid,
-                m.id,
-                m.media_type
-            FROM messages m
-            JOIN chats c ON m.chat_jid = c.jid
-            WHERE m.sender = ? OR c.jid = ?
-            ORDER BY m.timestamp DESC
+            SELECT timestamp, sender, content, is_from_me, chat_jid, id, media_type
+            FROM (
+                SELECT * FROM (
+                    SELECT timestamp, sender, content, is_from_me, chat_jid, id, media_type
+                    FROM messages
+                    WHERE sender = ?
+                    ORDER BY timestamp DESC
+                    LIMIT 1
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT timestamp, sender, content, is_from_me, chat_jid, id, media_type
+                    FROM messages
+                    WHERE chat_jid = ?
+                    ORDER BY timestamp DESC
+                    LIMIT 1
+                )
+            )
+            ORDER BY timestamp DESC
             LIMIT 1
         """, (jid, jid))
         
@@ -511,15 +892,17 @@ def get_last_interaction(jid: str) -> str:
         if not msg_data:
             return None
             
+        # get_sender_name falls back to the JID itself when the chat has no name
+        chat_name = get_sender_name(msg_data[4])
         message = Message(
-            timestamp=datetime.fromisoformat(msg_data[0]),
+            timestamp=_parse_timestamp(msg_data[0]),
             sender=msg_data[1],
-            chat_name=msg_data[2],
-            content=msg_data[3],
-            is_from_me=msg_data[4],
-            chat_jid=msg_data[5],
-            id=msg_data[6],
-            media_type=msg_data[7]
+            chat_name=chat_name if chat_name != msg_data[4] else None,
+            content=msg_data[2],
+            is_from_me=msg_data[3],
+            chat_jid=msg_data[4],
+            id=msg_data[5],
+            media_type=msg_data[6]
         )
         
         return format_message(message)
@@ -527,33 +910,26 @@ def get_last_interaction(jid: str) -> str:
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return None
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 
 def get_chat(chat_jid: str, include_last_message: bool = True) -> Optional[Chat]:
     """Get chat metadata by JID."""
     try:
-        conn = sqlite3.connect(MESSAGES_DB_PATH)
+        conn = _get_db()
         cursor = conn.cursor()
         
-        query = """
+        last_message_columns = "m.content, m.sender, m.is_from_me" if include_last_message else "NULL, NULL, NULL"
+        query = f"""
             SELECT 
                 c.jid,
                 c.name,
                 c.last_message_time,
-                m.content as last_message,
-                m.sender as last_sender,
-                m.is_from_me as last_is_from_me
+                {last_message_columns}
             FROM chats c
         """
         
         if include_last_message:
-            query += """
-                LEFT JOIN messages m ON c.jid = m.chat_jid 
-                AND c.last_message_time = m.timestamp
-            """
+            query += _LAST_MESSAGE_JOIN
             
         query += " WHERE c.jid = ?"
         
@@ -566,7 +942,7 @@ def get_chat(chat_jid: str, include_last_message: bool = True) -> Optional[Chat]
         return Chat(
             jid=chat_data[0],
             name=chat_data[1],
-            last_message_time=datetime.fromisoformat(chat_data[2]) if chat_data[2] else None,
+            last_message_time=_parse_timestamp(chat_data[2]) if chat_data[2] else None,
             last_message=chat_data[3],
             last_sender=chat_data[4],
             last_is_from_me=chat_data[5]
@@ -575,18 +951,15 @@ def get_chat(chat_jid: str, include_last_message: bool = True) -> Optional[Chat]
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return None
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 
 def get_direct_chat_by_contact(sender_phone_number: str) -> Optional[Chat]:
     """Get chat metadata by sender phone number."""
     try:
-        conn = sqlite3.connect(MESSAGES_DB_PATH)
+        conn = _get_db()
         cursor = conn.cursor()
         
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT 
                 c.jid,
                 c.name,
@@ -595,8 +968,7 @@ def get_direct_chat_by_contact(sender_phone_number: str) -> Optional[Chat]:
                 m.sender as last_sender,
                 m.is_from_me as last_is_from_me
             FROM chats c
-            LEFT JOIN messages m ON c.jid = m.chat_jid 
-                AND c.last_message_time = m.timestamp
+            {_LAST_MESSAGE_JOIN}
             WHERE c.jid LIKE ? AND c.jid NOT LIKE '%@g.us'
             LIMIT 1
         """, (f"%{sender_phone_number}%",))
@@ -609,7 +981,7 @@ def get_direct_chat_by_contact(sender_phone_number: str) -> Optional[Chat]:
         return Chat(
             jid=chat_data[0],
             name=chat_data[1],
-            last_message_time=datetime.fromisoformat(chat_data[2]) if chat_data[2] else None,
+            last_message_time=_parse_timestamp(chat_data[2]) if chat_data[2] else None,
             last_message=chat_data[3],
             last_sender=chat_data[4],
             last_is_from_me=chat_data[5]
@@ -618,15 +990,13 @@ def get_direct_chat_by_contact(sender_phone_number: str) -> Optional[Chat]:
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return None
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 def send_message(recipient: str, message: str) -> Tuple[bool, str]:
     try:
         # Validate input
-        if not recipient:
-            return False, "Recipient must be provided"
+        error = _validate_recipient(recipient)
+        if error:
+            return False, error
         
         url = f"{WHATSAPP_API_BASE_URL}/send"
         payload = {
@@ -634,7 +1004,7 @@ def send_message(recipient: str, message: str) -> Tuple[bool, str]:
             "message": message,
         }
         
-        response = requests.post(url, json=payload)
+        response = _SESSION.post(url, json=payload, timeout=_REQUEST_TIMEOUT)
         
         # Check if the request was successful
         if response.status_code == 200:
@@ -650,11 +1020,51 @@ def send_message(recipient: str, message: str) -> Tuple[bool, str]:
     except Exception as e:
         return False, f"Unexpected error: {str(e)}"
 
+async def _send_message_async(client: httpx.AsyncClient, recipient: str, message: str) -> Tuple[bool, str]:
+    error = _validate_recipient(recipient)
+    if error:
+        return False, error
+
+    try:
+        response = await client.post("/send", json={"recipient": recipient, "message": message})
+        if response.status_code == 200:
+            result = response.json()
+            return result.get("success", False), result.get("message", "Unknown response")
+        else:
+            return False, f"Error: HTTP {response.status_code} - {response.text}"
+    except httpx.HTTPError as e:
+        return False, f"Request error: {str(e)}"
+    except json.JSONDecodeError:
+        return False, f"Error parsing response: {response.text}"
+    except Exception as e:
+        return False, f"Unexpected error: {str(e)}"
+
+async def send_messages_bulk(recipients: List[str], message: str) -> List[Tuple[bool, str]]:
+    """Send the same message to many recipients concurrently.
+
+    Returns:
+        One (success, status message) tuple per recipient, in the order given
+    """
+    async with httpx.AsyncClient(
+        base_url=WHATSAPP_API_BASE_URL,
+        limits=httpx.Limits(max_connections=32),
+        # Requests beyond the pool size wait for a free connection rather than time out
+        timeout=httpx.Timeout(_REQUEST_TIMEOUT[1], connect=_REQUEST_TIMEOUT[0], pool=None)
+    ) as client:
+        return list(await asyncio.gather(
+            *(_send_message_async(client, recipient, message) for recipient in recipients)
+        ))
+
+def send_messages_bulk_sync(recipients: List[str], message: str) -> List[Tuple[bool, str]]:
+    """Blocking variant of send_messages_bulk for callers outside an event loop."""
+    return asyncio.run(send_messages_bulk(recipients, message))
+
 def send_file(recipient: str, media_path: str) -> Tuple[bool, str]:
     try:
         # Validate input
-        if not recipient:
-            return False, "Recipient must be provided"
+        error = _validate_recipient(recipient)
+        if error:
+            return False, error
         
         if not media_path:
             return False, "Media path must be provided"
@@ -668,7 +1078,7 @@ def send_file(recipient: str, media_path: str) -> Tuple[bool, str]:
             "media_path": media_path
         }
         
-        response = requests.post(url, json=payload)
+        response = _SESSION.post(url, json=payload, timeout=_REQUEST_TIMEOUT)
         
         # Check if the request was successful
         if response.status_code == 200:
@@ -687,8 +1097,9 @@ def send_file(recipient: str, media_path: str) -> Tuple[bool, str]:
 def send_audio_message(recipient: str, media_path: str) -> Tuple[bool, str]:
     try:
         # Validate input
-        if not recipient:
-            return False, "Recipient must be provided"
+        error = _validate_recipient(recipient)
+        if error:
+            return False, error
         
         if not media_path:
             return False, "Media path must be provided"
@@ -696,9 +1107,10 @@ def send_audio_message(recipient: str, media_path: str) -> Tuple[bool, str]:
         if not os.path.isfile(media_path):
             return False, f"Media file not found: {media_path}"
 
-        if not media_path.endswith(".ogg"):
+        # The bridge sends .ogg files as Opus voice notes, so only transcode anything else
+        if not audio.is_opus_ogg(media_path):
             try:
-                media_path = audio.convert_to_opus_ogg_temp(media_path)
+                media_path = audio.convert_to_opus_ogg_cached(media_path)
             except Exception as e:
                 return False, f"Error converting file to opus ogg. You likely need to install ffmpeg: {str(e)}"
         
@@ -708,7 +1120,7 @@ def send_audio_message(recipient: str, media_path: str) -> Tuple[bool, str]:
             "media_path": media_path
         }
         
-        response = requests.post(url, json=payload)
+        response = _SESSION.post(url, json=payload, timeout=_REQUEST_TIMEOUT)
         
         # Check if the request was successful
         if response.status_code == 200:
@@ -741,7 +1153,7 @@ def download_media(message_id: str, chat_jid: str) -> Optional[str]:
             "chat_jid": chat_jid
         }
         
-        response = requests.post(url, json=payload)
+        response = _SESSION.post(url, json=payload, timeout=_REQUEST_TIMEOUT)
         
         if response.status_code == 200:
             result = response.json()
@@ -765,3 +1177,16 @@ def download_media(message_id: str, chat_jid: str) -> Optional[str]:
     except Exception as e:
         print(f"Unexpected error: {str(e)}")
         return None
+
+def download_media_bulk(media: List[Tuple[str, str]]) -> List[Optional[str]]:
+    """Download media from several messages concurrently.
+    
+    Args:
+        media: (message_id, chat_jid) pairs of the messages containing the media
+    
+    Returns:
+        The local file path of each download, or None where it failed, in the order given
+    """
+    # Downloads are network-bound, so threads overlap them; they share _SESSION's connection pool
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(lambda pair: download_media(*pair), media))